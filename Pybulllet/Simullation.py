@@ -12,12 +12,18 @@ import torch
 from PIL import Image
 import clip
 import math
+import argparse
+from collections import OrderedDict
 
 # --------------------------- Configuration ---------------------------
-SIM_WIDTH = 320
-SIM_HEIGHT = 240
+SIM_WIDTH = 160  # Camera only feeds visibility checks; cubes still span ~7 px
+SIM_HEIGHT = 120
 CLIP_MODEL = 'ViT-B/32'
 EE_LINK_INDEX = 6
+CLIP_CACHE_SIZE = 64
+CLIP_PHRASE_CACHE_SIZE = 512
+CLIP_BATCH_BUCKETS = (4, 8, 16)  # Fixed text batch shapes for the compiled encoder
+SIM_TIME_STEP = 1.0/240.0
 
 # ========================== ACTION TOKENIZER ==========================
 class ActionTokenizerV2:
@@ -32,22 +38,33 @@ class ActionTokenizerV2:
         self.y_bins = torch.linspace(-half_size, half_size, 11)
         self.z_bins = torch.linspace(0, env_height_meters, 11)
         self.yaw_bins = torch.linspace(-math.pi/2, math.pi/2, 11)
+        # Bin midpoints + token strings, so lookups are a binary search
+        self._x_axis = self._build_axis(self.x_bins, "POS_X")
+        self._y_axis = self._build_axis(self.y_bins, "POS_Y")
+        self._z_axis = self._build_axis(self.z_bins, "POS_Z")
+        self._yaw_axis = self._build_axis(self.yaw_bins, "ROT_YAW")
         print("[Tokenizer] Initialized with 11 bins per dimension")
 
-    def discretize(self, value, bins, prefix):
+    @staticmethod
+    def _build_axis(bins, prefix):
+        """Precompute bin midpoints and token strings for one axis"""
+        mids = ((bins[:-1] + bins[1:]) / 2).numpy()
+        center = (len(bins) - 1) // 2
+        tokens = [f"{prefix}_{i - center:+d}" for i in range(len(bins))]
+        return mids, tokens
+
+    def discretize(self, value, axis):
         """Find closest bin index and convert to token"""
-        if not isinstance(value, torch.Tensor):
-            value = torch.tensor(float(value))
-        idx = torch.argmin(torch.abs(bins - value)).item()
-        token_val = idx - 5  # Center at 0: [-5, -4, ..., 0, ..., 4, 5]
-        return f"{prefix}_{token_val:+d}"
+        mids, tokens = axis
+        idx = int(np.searchsorted(mids, float(value)))
+        return tokens[idx]  # Centered at 0: [-5, -4, ..., 0, ..., 4, 5]
 
     def position_to_tokens(self, pos, rotation=0.0):
         """Convert 3D position to discrete tokens"""
-        x_token = self.discretize(pos[0], self.x_bins, "POS_X")
-        y_token = self.discretize(pos[1], self.y_bins, "POS_Y")
-        z_token = self.discretize(pos[2], self.z_bins, "POS_Z")
-        yaw_token = self.discretize(rotation, self.yaw_bins, "ROT_YAW")
+        x_token = self.discretize(pos[0], self._x_axis)
+        y_token = self.discretize(pos[1], self._y_axis)
+        z_token = self.discretize(pos[2], self._z_axis)
+        yaw_token = self.discretize(rotation, self._yaw_axis)
         return [x_token, y_token, z_token, yaw_token]
 
     def action_to_tokens(self, action_type, pos, rotation=0.0):
@@ -64,21 +81,25 @@ class ObjectDatabase:
     """
     def __init__(self):
         self.objects = {}
+        self.by_uid = {}
         print("[Database] Initialized object tracking")
     
     def update_from_pybullet(self, cubes_dict):
         """Update object positions from PyBullet simulation"""
         self.objects = {}
+        self.by_uid = {}
         for uid, meta in cubes_dict.items():
             pos, orn = p.getBasePositionAndOrientation(uid)
             euler = p.getEulerFromQuaternion(orn)
-            self.objects[meta['name']] = {
+            data = {
                 'uid': uid,
                 'pos': pos,
                 'rotation': euler[2],  # yaw
                 'type': 'item',
                 'meta': meta
             }
+            self.objects[meta['name']] = data
+            self.by_uid[uid] = data
     
     def find_object(self, name):
         """Find object by name"""
@@ -87,6 +108,10 @@ class ObjectDatabase:
                 return data
         return None
 
+    def find_by_uid(self, uid):
+        """Find object by PyBullet uid"""
+        return self.by_uid.get(uid)
+
 # ========================== ACTION EXECUTOR ==========================
 class ActionExecutor:
     """
@@ -100,66 +125,106 @@ class ActionExecutor:
         print("[Executor] Initialized at home position")
     
     def generate_pick_actions(self, pos, is_final=False):
-        """Generate 8D action sequence for picking"""
-        actions = []
+        """Generate 8D action sequence for picking, as a (4, 8) array"""
         pos_above = (pos[0], pos[1], pos[2] + 0.1)
+        terminate_flag = 1 if is_final else 0
         
-        # Move above
-        actions.append((0, *pos_above, *self.home_rot, 1))
-        # Move down
-        actions.append((0, *pos, *self.home_rot, 1))
-        # Close gripper
+        # Rows: move above, move down, close gripper, lift (terminate if final)
+        actions = np.empty((4, 8), dtype=np.float32)
+        actions[:, 0] = (0, 0, 0, terminate_flag)
+        actions[:, 1:4] = (pos_above, pos, pos, pos_above)
+        actions[:, 4:7] = self.home_rot
+        actions[:, 7] = (1, 1, 0, 0)
         self.gripper_open = 0
-        actions.append((0, *pos, *self.home_rot, 0))
-        # Lift (terminate if this is the final action)
-        terminate_flag = 1 if is_final else 0
-        actions.append((terminate_flag, *pos_above, *self.home_rot, 0))
         
         return actions
     
     def generate_place_actions(self, pos, is_final=False):
-        """Generate 8D action sequence for placing"""
-        actions = []
+        """Generate 8D action sequence for placing, as a (5, 8) array"""
         pos_above = (pos[0], pos[1], pos[2] + 0.1)
+        terminate_flag = 1 if is_final else 0
         
-        # Move above
-        actions.append((0, *pos_above, *self.home_rot, 0))
-        # Move down
-        actions.append((0, *pos, *self.home_rot, 0))
-        # Open gripper
+        # Rows: move above, move down, open gripper, lift, return home (terminate if final)
+        actions = np.empty((5, 8), dtype=np.float32)
+        actions[:, 0] = (0, 0, 0, 0, terminate_flag)
+        actions[:, 1:4] = (pos_above, pos, pos, pos_above, self.home_pos)
+        actions[:, 4:7] = self.home_rot
+        actions[:, 7] = (0, 0, 1, 1, 1)
         self.gripper_open = 1
-        actions.append((0, *pos, *self.home_rot, 1))
-        # Lift and return home (terminate if this is the final action)
-        terminate_flag = 1 if is_final else 0
-        actions.append((0, *pos_above, *self.home_rot, 1))
-        # Final home position with terminate flag
-        actions.append((terminate_flag, *self.home_pos, *self.home_rot, 1))
         
         return actions
     
     def format_action(self, action_vector):
         """Format 8D vector for display"""
-        return (f"({action_vector[0]}, "
-                f"{action_vector[1]:.2f}, {action_vector[2]:.2f}, {action_vector[3]:.2f}, "
-                f"{action_vector[4]:.2f}, {action_vector[5]:.2f}, {action_vector[6]:.2f}, "
-                f"{action_vector[7]})")
+        terminate, x, y, z, roll, pitch, yaw, gripper = action_vector
+        return (f"({int(terminate)}, {x:.2f}, {y:.2f}, {z:.2f}, "
+                f"{roll:.2f}, {pitch:.2f}, {yaw:.2f}, {int(gripper)})")
 
 # ========================== CLIP MATCHER ==========================
+# Command parsing patterns, compiled once at import
+_GROUND_KEYWORDS = frozenset(['ground', 'table', 'floor', 'down', 'surface'])
+_PICK_RES = [re.compile(pattern) for pattern in [
+    r"(?:pick\s+up|pick|grab|take|lift|get)\s+(?:the\s+)?(\w+)",
+    r"(?:pick\s+up|pick|grab|take|lift|get)\s+(?:the\s+)?(\w+\s+\w+)",
+]]
+_PLACE_RES = [re.compile(pattern) for pattern in [
+    r"(?:place|put|set|drop|move).*?(?:on|onto|to|at|over)\s+(?:the\s+)?(\w+)",
+    r"(?:on|onto|to|at|over)\s+(?:the\s+)?(\w+\s+\w+)",
+    r"(?:on|onto|to|at|over)\s+(?:the\s+)?(\w+)",
+]]
+
 class CLIPMatcher:
     """Visual-language understanding using CLIP"""
     def __init__(self, model_name=CLIP_MODEL):
         print(f'[CLIP] Loading model: {model_name}...')
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model, self.preprocess = clip.load(model_name, device=self.device)
+        self.model, self.preprocess = self._load(model_name)
         self.model.eval()
+        self._encode = self.model.encode_text
+        self._compiled = False
+        if self.device == "cuda":
+            # FP16 text tower + CUDA graphs via torch.compile
+            self.model = self.model.half()
+            self._encode = torch.compile(self.model.encode_text, mode='reduce-overhead',
+                                         dynamic=False)
+            self._compiled = True
+        self._cand_cache = OrderedDict()
+        self._phrase_cache = OrderedDict()
+        self._decision_cache = OrderedDict()
         print(f'[CLIP] Loaded on device: {self.device}')
+        start = time.perf_counter()
         self._warmup()
-        print('[CLIP] Ready!')
+        print(f'[CLIP] Ready! (warmup {time.perf_counter() - start:.2f}s)')
     
-    def _warmup(self):
-        """Warm up model to avoid first-run delays"""
+    def _load(self, model_name):
+        """Load CLIP; on CPU prefer OpenAI's TorchScript archive (no per-op Python dispatch)"""
+        if self.device == "cpu":
+            try:
+                model, preprocess = clip.load(model_name, device=self.device, jit=True)
+                # The archive targets an older torch; graph errors only show up when run
+                with torch.inference_mode():
+                    model.encode_text(clip.tokenize(["red cube"]))
+                return model, preprocess
+            except Exception as e:
+                print(f'[CLIP] TorchScript model unavailable ({e}), loading eager model')
+        return clip.load(model_name, device=self.device)
+
+    def _warmup(self, iterations=3):
+        """Warm up model to avoid first-run delays (and trigger graph capture)"""
         dummy_texts = ["red cube", "blue block", "green object"]
-        with torch.no_grad():
+        try:
+            # Compiled path: capture a graph for every padded batch size up front
+            sizes = CLIP_BATCH_BUCKETS if self._compiled else (len(dummy_texts),)
+            for size in sizes:
+                batch = [dummy_texts[i % len(dummy_texts)] for i in range(size)]
+                for _ in range(iterations):
+                    _ = self.encode_text(batch)
+        except Exception as e:
+            if not self._compiled:
+                raise
+            print(f'[CLIP] torch.compile unavailable ({e}), using eager mode')
+            self._encode = self.model.encode_text
+            self._compiled = False
             _ = self.encode_text(dummy_texts)
         if self.device == "cuda":
             torch.cuda.empty_cache()
@@ -168,15 +233,98 @@ class CLIPMatcher:
         """Encode text using CLIP"""
         if isinstance(texts, str):
             texts = [texts]
-        text_tokens = clip.tokenize(texts, truncate=True).to(self.device)
-        with torch.no_grad():
-            text_features = self.model.encode_text(text_tokens)
+        text_tokens = clip.tokenize(texts, truncate=True)
+        if self.device == "cuda":
+            # Async H2D copy from page-locked memory
+            text_tokens = text_tokens.pin_memory().to(self.device, non_blocking=True)
+        with torch.inference_mode(), torch.autocast('cuda', dtype=torch.float16,
+                                                    enabled=self.device == "cuda"):
+            text_features = self._run_encoder(text_tokens)
             text_features = text_features / text_features.norm(dim=-1, keepdim=True)
         return text_features.float()
 
+    def _run_encoder(self, text_tokens):
+        """Run the text tower; compiled path pads batches to CLIP_BATCH_BUCKETS sizes"""
+        if not self._compiled:
+            return self._encode(text_tokens)
+        if len(text_tokens) == 0:
+            return self.model.encode_text(text_tokens)
+        # Fixed shapes keep torch.compile/CUDA graphs from recompiling per batch size
+        outputs = []
+        for chunk in text_tokens.split(CLIP_BATCH_BUCKETS[-1]):
+            n = len(chunk)
+            size = next(b for b in CLIP_BATCH_BUCKETS if b >= n)
+            if size > n:
+                chunk = torch.cat([chunk, chunk.new_zeros(size - n, chunk.shape[1])])
+            # Copy out: the next CUDA-graph replay overwrites this chunk's output buffer
+            outputs.append(self._encode(chunk)[:n].clone())
+        return torch.cat(outputs)
+
+    def _cache_get(self, cache, key):
+        """LRU lookup: move hit to the most-recent end"""
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+    def _cache_put(self, cache, key, value, max_size=CLIP_CACHE_SIZE):
+        """LRU insert bounded by max_size"""
+        cache[key] = value
+        cache.move_to_end(key)
+        if len(cache) > max_size:
+            cache.popitem(last=False)
+
+    def encode_phrases(self, phrases):
+        """
+        Encode phrases in one batched forward pass, reusing cached features
+        Returns: (len(phrases), D) tensor
+        """
+        missing = [t for t in dict.fromkeys(phrases)
+                   if self._cache_get(self._phrase_cache, t) is None]
+        if missing:
+            features = self.encode_text(missing)
+            # Clone rows so each cache entry owns its storage (a view pins the whole batch)
+            for t, feat in zip(missing, features):
+                self._cache_put(self._phrase_cache, t, feat.clone(), CLIP_PHRASE_CACHE_SIZE)
+        return torch.stack([self._phrase_cache[t] for t in phrases])
+
+    @staticmethod
+    def phrase_variations(phrase):
+        """Article/noun variations scored together for a phrase"""
+        return [
+            phrase,
+            f"the {phrase}",
+            f"{phrase} cube",
+            f"{phrase} block",
+        ]
+
+    @staticmethod
+    def _scene_key(objects_meta):
+        """Hashable (uid, name) summary of the candidate objects"""
+        return tuple(sorted((uid, meta.get('name', 'object'))
+                            for uid, meta in objects_meta.items()))
+
+    def candidate_features(self, objects_meta):
+        """
+        Encode object descriptions, cached by the scene's (uid, name) pairs
+        Returns: (cand_features, cand_index_to_uid)
+        """
+        key = self._scene_key(objects_meta)
+        cached = self._cache_get(self._cand_cache, key)
+        if cached is not None:
+            return cached
+
+        # One canonical description per object; phrase variations cover the rest
+        lookup_texts = [f"{color_name} cube" for _, color_name in key]
+        cand_index_to_uid = [uid for uid, _ in key]
+
+        cached = (self.encode_text(lookup_texts), cand_index_to_uid)
+        self._cache_put(self._cand_cache, key, cached)
+        return cached
+
     def compute_similarity(self, query_features, candidate_features):
         """Compute cosine similarity"""
-        similarity = (query_features @ candidate_features.T).squeeze()
+        similarity = query_features @ candidate_features.T
         return similarity
 
     def pick_and_place_from_text(self, text, objects_meta):
@@ -185,91 +333,79 @@ class CLIPMatcher:
         Returns: (pick_uid, place_uid_or_special, debug_scores)
         """
         txt = text.lower()
-        
+        # Decisions depend only on the command and the visible (uid, name) pairs
+        key = (' '.join(txt.split()), self._scene_key(objects_meta))
+        cached = self._cache_get(self._decision_cache, key)
+        if cached is not None:
+            pick_uid, place_uid, debug_scores = cached
+            print(f"[CLIP] Reusing decision: pick uid={pick_uid}, place uid={place_uid}")
+            return pick_uid, place_uid, dict(debug_scores)
+
+        pick_uid, place_uid, debug_scores = self._match(txt, objects_meta)
+        self._cache_put(self._decision_cache, key, (pick_uid, place_uid, dict(debug_scores)))
+        return pick_uid, place_uid, debug_scores
+
+    @torch.inference_mode()
+    def _match(self, txt, objects_meta):
+        """Run the regex + CLIP matching pipeline on a lowercased command"""
         # Check for ground placement
-        ground_keywords = ['ground', 'table', 'floor', 'down', 'surface']
-        place_on_ground = any(keyword in txt for keyword in ground_keywords)
+        place_on_ground = any(keyword in txt for keyword in _GROUND_KEYWORDS)
         
         pick_phrase = None
         place_phrase = None
 
         # Extract pick phrase
-        pick_patterns = [
-            r"(?:pick\s+up|pick|grab|take|lift|get)\s+(?:the\s+)?(\w+)",
-            r"(?:pick\s+up|pick|grab|take|lift|get)\s+(?:the\s+)?(\w+\s+\w+)",
-        ]
-        for pattern in pick_patterns:
-            pick_match = re.search(pattern, txt)
+        for pattern in _PICK_RES:
+            pick_match = pattern.search(txt)
             if pick_match:
                 pick_phrase = pick_match.group(1).strip()
                 break
 
         # Extract place phrase
-        place_patterns = [
-            r"(?:place|put|set|drop|move).*?(?:on|onto|to|at|over)\s+(?:the\s+)?(\w+)",
-            r"(?:on|onto|to|at|over)\s+(?:the\s+)?(\w+\s+\w+)",
-            r"(?:on|onto|to|at|over)\s+(?:the\s+)?(\w+)",
-        ]
-        for pattern in place_patterns:
-            place_match = re.search(pattern, txt)
+        for pattern in _PLACE_RES:
+            place_match = pattern.search(txt)
             if place_match:
                 place_phrase = place_match.group(1).strip()
-                if any(keyword in place_phrase for keyword in ground_keywords):
+                if any(keyword in place_phrase for keyword in _GROUND_KEYWORDS):
                     place_on_ground = True
                 break
 
-        # Build candidate descriptions
-        uid_list = list(objects_meta.keys())
-        uid_to_texts = {}
-        lookup_texts = []
-        cand_index_to_uid = []
-        
-        for uid, meta in objects_meta.items():
-            color_name = meta.get('name', 'object')
-            texts = [
-                f"{color_name}",
-                f"{color_name} cube",
-                f"{color_name} block",
-                f"the {color_name}",
-                f"the {color_name} cube",
-            ]
-            uid_to_texts[uid] = texts
-            for t in texts:
-                lookup_texts.append(t)
-                cand_index_to_uid.append(uid)
-
-        cand_features = self.encode_text(lookup_texts)
+        cand_features, cand_index_to_uid = self.candidate_features(objects_meta)
+
+        # Score pick, place and fallback variations against all candidates in one matmul
+        phrases = [phrase for phrase in (pick_phrase, place_phrase) if phrase]
+        if pick_phrase is None and not any(meta['name'] in txt for meta in objects_meta.values()):
+            phrases.append(txt)  # Fallback below will score the whole command
+        phrase_sims = {}
+        if phrases:
+            variations = [self.phrase_variations(phrase) for phrase in phrases]
+            phrase_features = self.encode_phrases([v for vs in variations for v in vs])
+            similarities = self.compute_similarity(phrase_features, cand_features)
+            max_sims = similarities.view(
+                len(phrases), len(variations[0]), len(cand_index_to_uid)
+            ).max(dim=1)[0]
+            phrase_sims = dict(zip(phrases, max_sims))
 
         def best_uid_for(phrase, exclude_uid=None):
             """Find best matching object"""
-            phrase_variations = [
-                phrase,
-                f"the {phrase}",
-                f"{phrase} cube",
-                f"{phrase} block",
-            ]
+            max_sims = phrase_sims.get(phrase)
+            if max_sims is None:
+                phrase_features = self.encode_phrases(self.phrase_variations(phrase))
+                similarities = self.compute_similarity(phrase_features, cand_features)
+                max_sims = similarities.max(dim=0)[0]
             
-            all_sims = []
-            for var in phrase_variations:
-                phrase_feature = self.encode_text([var])
-                similarities = self.compute_similarity(phrase_feature, cand_features)
-                all_sims.append(similarities)
-            
-            max_sims = torch.stack(all_sims).max(dim=0)[0]
-            
-            uid_scores = {}
-            for idx, sim in enumerate(max_sims):
-                uid = cand_index_to_uid[idx]
-                if exclude_uid and uid == exclude_uid:
-                    continue
-                score = float(sim)
-                uid_scores[uid] = max(uid_scores.get(uid, -1.0), score)
-            
-            if not uid_scores:
+            # One row per uid, so the reduction is a masked argmax on-device
+            if exclude_uid is not None and exclude_uid in cand_index_to_uid:
+                max_sims = max_sims.clone()
+                max_sims[cand_index_to_uid.index(exclude_uid)] = float('-inf')
+            if max_sims.numel() == 0:
                 return None, 0.0
                 
-            best_uid = max(uid_scores.items(), key=lambda x: x[1])
-            return best_uid[0], best_uid[1]
+            best_col = int(max_sims.argmax())
+            best_score = float(max_sims[best_col])
+            if best_score == float('-inf'):
+                return None, 0.0
+            return cand_index_to_uid[best_col], best_score
 
         pick_uid = None
         place_uid = None
@@ -312,31 +448,33 @@ class SimpleController:
     def __init__(self, robot_id):
         self.robot = robot_id
         self.ee_index = EE_LINK_INDEX
+        # Joint layout is fixed for the robot; IK returns one pose per movable joint
+        self._movable = [
+            j for j in range(p.getNumJoints(robot_id))
+            if p.getJointInfo(robot_id, j)[2] != p.JOINT_FIXED
+        ]
+        self._forces = [200] * len(self._movable)
+        # Only pace stepping to wall-clock when there is a GUI to watch
+        self._realtime = is_gui_connection()
 
     def move_to(self, target_pos, target_ori=None, steps=120):
         if target_ori is None:
             target_ori = p.getQuaternionFromEuler([0, 3.14, 0])
-        for i in range(steps):
-            joint_poses = p.calculateInverseKinematics(
-                self.robot, self.ee_index, target_pos, target_ori
-            )
-            num_joints = p.getNumJoints(self.robot)
-            for j in range(num_joints):
-                info = p.getJointInfo(self.robot, j)
-                if info[2] == p.JOINT_FIXED:
-                    continue
-                try:
-                    p.setJointMotorControl2(
-                        self.robot, j, p.POSITION_CONTROL, 
-                        joint_poses[j], force=200
-                    )
-                except Exception:
-                    pass
-            p.stepSimulation()
-            time.sleep(1.0/240.0)
-
-    def pick(self, obj_id):
-        pos, orn = p.getBasePositionAndOrientation(obj_id)
+        # Target is fixed for the whole move, so solve IK once (to tighter tolerance)
+        joint_poses = p.calculateInverseKinematics(
+            self.robot, self.ee_index, target_pos, target_ori,
+            maxNumIterations=100, residualThreshold=1e-4
+        )
+        # Motor targets persist across steps, so they are set once per move
+        p.setJointMotorControlArray(
+            self.robot, self._movable, p.POSITION_CONTROL,
+            targetPositions=joint_poses, forces=self._forces
+        )
+        step_simulation(steps, realtime=self._realtime)
+
+    def pick(self, obj_id, pos=None):
+        if pos is None:
+            pos, _ = p.getBasePositionAndOrientation(obj_id)
         pre_pos = [pos[0], pos[1], pos[2] + 0.18]
         grasp_pos = [pos[0], pos[1], pos[2] + 0.02]
         self.move_to(pre_pos, steps=80)
@@ -369,6 +507,17 @@ def connect_pybullet(gui=True):
     p.setAdditionalSearchPath(pybullet_data.getDataPath())
     p.setGravity(0, 0, -9.81)
 
+def is_gui_connection():
+    """True when connected through the PyBullet GUI (vs. headless DIRECT)"""
+    return p.getConnectionInfo()['connectionMethod'] == p.GUI
+
+def step_simulation(steps, realtime=False):
+    """Advance the simulation by `steps` ticks, paced to wall-clock only when realtime"""
+    for _ in range(steps):
+        p.stepSimulation()
+        if realtime:
+            time.sleep(SIM_TIME_STEP)
+
 def create_scene():
     plane = p.loadURDF('plane.urdf')
     robot = p.loadURDF('kuka_iiwa/model.urdf', useFixedBase=True)
@@ -395,39 +544,42 @@ def create_scene():
 
     return robot, cube_ids
 
+# Camera is static, so its matrices are computed once (pure math, no connection needed)
+_VIEW = p.computeViewMatrixFromYawPitchRoll(
+    cameraTargetPosition=[0.6, 0, 0.05],
+    distance=0.9, yaw=90, pitch=-20, 
+    roll=0, upAxisIndex=2
+)
+_PROJ = p.computeProjectionMatrixFOV(
+    fov=60, aspect=SIM_WIDTH/SIM_HEIGHT, 
+    nearVal=0.01, farVal=3.1
+)
+
 def get_camera_image_and_seg():
-    cam_target = [0.6, 0, 0.05]
-    distance = 0.9
-    yaw = 90
-    pitch = -20
-    roll = 0
-    
-    view = p.computeViewMatrixFromYawPitchRoll(
-        cameraTargetPosition=cam_target,
-        distance=distance, yaw=yaw, pitch=pitch, 
-        roll=roll, upAxisIndex=2
-    )
-    proj = p.computeProjectionMatrixFOV(
-        fov=60, aspect=SIM_WIDTH/SIM_HEIGHT, 
-        nearVal=0.01, farVal=3.1
-    )
-    w, h, px, depth, seg = p.getCameraImage(
+    # Headless DIRECT clients have no GL context; use the CPU rasterizer there
+    if is_gui_connection():
+        renderer = p.ER_BULLET_HARDWARE_OPENGL
+    else:
+        renderer = p.ER_TINY_RENDERER
+    w, h, px, _, seg = p.getCameraImage(
         SIM_WIDTH, SIM_HEIGHT, 
-        viewMatrix=view, projectionMatrix=proj,
-        renderer=p.ER_BULLET_HARDWARE_OPENGL
+        viewMatrix=_VIEW, projectionMatrix=_PROJ,
+        renderer=renderer
     )
-    img = np.reshape(px, (h, w, 4))[:, :, :3]
-    seg = np.array(seg).reshape((h, w))
+    img = np.asarray(px, dtype=np.uint8).reshape(h, w, 4)[..., :3]  # view, no copy
+    seg = np.asarray(seg, dtype=np.int32).reshape(h, w)
     return img, seg
 
 # ========================== MAIN LOOP ==========================
-def main():
+def main(gui=True):
     # Initialize all systems
-    connect_pybullet(gui=True)
+    connect_pybullet(gui=gui)
     robot, cubes = create_scene()
     
     controller = SimpleController(robot)
+    realtime = is_gui_connection()
     matcher = CLIPMatcher()
+    matcher.candidate_features(cubes)  # Pre-encode the full scene before the first command
     tokenizer = ActionTokenizerV2(env_size_meters=3.0, env_height_meters=1.0)
     executor = ActionExecutor()
     database = ObjectDatabase()
@@ -446,14 +598,13 @@ def main():
     print('='*60 + '\n')
 
     while True:
-        # Simulation step
-        for _ in range(15):
-            p.stepSimulation()
-            time.sleep(1.0/240.0)
+        # Simulation step (lets released cubes settle before the camera reads the scene)
+        step_simulation(15, realtime=realtime)
 
         # Get scene information
         img, seg = get_camera_image_and_seg()
-        visible_uids = [u for u in cubes.keys() if (seg == u).any()]
+        present = set(np.unique(seg).tolist())
+        visible_uids = [u for u in cubes.keys() if u in present]
         objects_meta = {u: cubes[u] for u in visible_uids}
         
         # Update object database
@@ -461,7 +612,7 @@ def main():
 
         print('\n📦 Visible objects:')
         for u, m in objects_meta.items():
-            pos, _ = p.getBasePositionAndOrientation(u)
+            pos = database.find_by_uid(u)['pos']
             print(f"  • {m['name']} cube at ({pos[0]:.2f}, {pos[1]:.2f}, {pos[2]:.2f})")
 
         # Get user command
@@ -483,14 +634,14 @@ def main():
             print('❌ Could not identify object to pick. Try a clearer command.')
             continue
 
-        # Get object positions
-        pick_pos, pick_orn = p.getBasePositionAndOrientation(pick_uid)
-        pick_euler = p.getEulerFromQuaternion(pick_orn)
+        # Get object positions (snapshot taken before the command; nothing has moved since)
+        pick_obj = database.find_by_uid(pick_uid)
+        pick_pos = pick_obj['pos']
         
         print(f'\n✓ Pick target: {objects_meta[pick_uid]["name"]} cube')
         
         # Generate PICK tokens
-        pick_tokens = tokenizer.action_to_tokens("PICK", pick_pos, pick_euler[2])
+        pick_tokens = tokenizer.action_to_tokens("PICK", pick_pos, pick_obj['rotation'])
         print(f'\n📝 ACTION TOKENS (PICK):')
         print(f'   {" ".join(pick_tokens)}')
         
@@ -502,7 +653,7 @@ def main():
         
         # Execute pick
         print(f'\n▶️  Executing PICK...')
-        cid = controller.pick(pick_uid)
+        cid = controller.pick(pick_uid, pick_pos)
 
         # Determine drop location
         if place_uid == "GROUND":
@@ -510,6 +661,7 @@ def main():
             drop_pos = [pick_pos[0] - 0.1, pick_pos[1], 0.03]
         elif place_uid is not None:
             print(f'\n✓ Place target: {objects_meta[place_uid]["name"]} cube')
+            # Re-read: the pick may have moved the target (e.g. it was stacked on the picked cube)
             tgt_pos, _ = p.getBasePositionAndOrientation(place_uid)
             drop_pos = [tgt_pos[0], tgt_pos[1], tgt_pos[2] + 0.06]
         else:
@@ -540,4 +692,8 @@ def main():
     print('\nSimulation ended. Goodbye!')
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='RT-2 PyBullet simulation')
+    parser.add_argument('--headless', action='store_true',
+                        help='run without the PyBullet GUI (DIRECT mode, no real-time pacing)')
+    args = parser.parse_args()
+    main(gui=not args.headless)
\ No newline at end of file